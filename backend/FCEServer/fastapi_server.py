@@ -1,13 +1,31 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+import numpy as np
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM, StoppingCriteria, StoppingCriteriaList
+from transformers.models.auto.modeling_auto import MODEL_FOR_SEQ_TO_SEQ_CAUSAL_LM_MAPPING
 import re
+import copy
 import difflib
 import os
 import joblib
+import asyncio
+import bisect
+import functools
+import hashlib
+import itertools
+import shutil
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from huggingface_hub import snapshot_download
+from huggingface_hub import constants as hf_constants
+
+try:
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+except ImportError:
+    ORTModelForSeq2SeqLM = None
 
 # =========================
 # Configuration
@@ -21,10 +39,57 @@ class Config:
 
     HF_TOKEN = os.environ.get("HF_TOKEN", None)
 
+    # Hub cache for every download: $HF_HUB_CACHE when set, else the Hugging Face default
+    # (None -> $HF_HOME/hub). FCE_HF_CACHE opts in to a dedicated directory such as
+    # /opt/hf-cache, baked into the image with `python fastapi_server.py --download-only`
+    # so startup never needs the network
+    FCE_HF_CACHE = os.environ.get("FCE_HF_CACHE")
+    CACHE_DIR = FCE_HF_CACHE or os.environ.get("HF_HUB_CACHE") or None
+
     DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Uvicorn worker processes. Each one loads its own copy of the model, so a single worker
+    # unless WEB_CONCURRENCY asks for more (CPU only; on GPU the batching queue provides concurrency)
+    WORKERS = 1 if DEVICE == "cuda" else int(os.environ.get("WEB_CONCURRENCY", 1))
     MAX_ENCODER_LEN = 512
     DEFAULT_MAX_NEW_TOKENS = 256
 
+    # Decoding
+    BEAM_WIDTH = int(os.environ.get("FCE_BEAMS", 2))
+    # Optional small seq2seq draft model (same tokenizer) for assisted decoding;
+    # only used for greedy search (FCE_BEAMS=1) on single-request batches
+    DRAFT_MODEL_REF = os.environ.get("FCE_DRAFT_MODEL_REF", None)
+
+    # Serve through ONNX Runtime when optimum[onnxruntime] is installed. On by default on CPU
+    # only: on GPU the PyTorch path keeps bf16, torch.compile and the static KV cache
+    USE_ONNXRUNTIME = os.environ.get("FCE_USE_ONNXRUNTIME", "1" if DEVICE == "cpu" else "0") == "1"
+    # Exported (and on CPU, INT8-quantized) ONNX models: written once, by --download-only or
+    # the first startup, then loaded from here by every worker
+    ONNX_DIR = os.environ.get("FCE_ONNX_DIR") or os.path.join(
+        FCE_HF_CACHE or hf_constants.HF_HOME, "fce-onnx"
+    )
+
+    # INT8 dynamic quantization of Linear layers when running on CPU (PyTorch backend)
+    QUANTIZE_CPU = os.environ.get("FCE_QUANTIZE_CPU", "1") == "1"
+
+    # torch.compile the model forward on CUDA (PyTorch backend, torch >= 2.2)
+    TORCH_COMPILE = os.environ.get("FCE_TORCH_COMPILE", "1") == "1"
+
+    # In-process LRU of (normalized input, max_length) -> corrected text
+    CACHE_SIZE = int(os.environ.get("FCE_CACHE_SIZE", 1024))
+
+    # Dynamic batching of concurrent /correct requests
+    MAX_BATCH = int(os.environ.get("FCE_MAX_BATCH", 8))
+    BATCH_TIMEOUT_MS = int(os.environ.get("FCE_BATCH_TIMEOUT_MS", 10))
+    # Token-length bucket edges: [0,64), [64,128), [128,256), [256,MAX_ENCODER_LEN]
+    LENGTH_BUCKET_EDGES = (64, 128, 256)
+    # With a compiled model, max_new_tokens is rounded up to one of these so the
+    # static KV cache (and captured CUDA graphs) are reused across requests
+    MAX_NEW_TOKENS_BUCKETS = (64, 128, 256)
+    # ...and batches are padded up to one of these sizes (powers of two up to MAX_BATCH);
+    # every batch size / encoder length pair is compiled at startup
+    BATCH_SIZE_BUCKETS = tuple(sorted({2 ** i for i in range(MAX_BATCH.bit_length())} | {MAX_BATCH}))
+
     INSTRUCTION_PREFIX = (
         "fix_grammar Keep meaning. Improve grammar, spelling, and punctuation. "
         "Output only the corrected text."
@@ -42,6 +107,12 @@ config = Config()
 
 ARTICLES = {"a", "an", "the"}
 
+_WP_RE = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)?|\d+|[^\w\s]")
+
+# Tokens that attach to the previous token (no space before) when rejoining; only commas
+# and full stops, as in the original " ,"/" ." replacements, so change text is unchanged
+_PUNCT = frozenset(",.")
+
 MICRO_FEEDBACK = {
     "agreement/plural": (
         "Check agreement (subject–verb and singular/plural nouns). "
@@ -66,7 +137,8 @@ MICRO_FEEDBACK = {
 class CorrectionRequest(BaseModel):
     student_input: str
     prompt: str = ""
-    max_length: int = config.DEFAULT_MAX_NEW_TOKENS
+    # Capped at the largest bucket: above it every value would be a new static cache shape
+    max_length: int = Field(config.DEFAULT_MAX_NEW_TOKENS, ge=1, le=max(config.MAX_NEW_TOKENS_BUCKETS))
 
 
 class CorrectionResponse(BaseModel):
@@ -100,18 +172,157 @@ app.add_middleware(
 # Model Manager
 # =========================
 
+def _hub_kwargs(ref: str) -> dict:
+    """Hub download kwargs for a model reference. Local paths need none; Hub repos use the shared cache."""
+    if os.path.exists(ref):
+        return {}
+
+    kwargs = {"cache_dir": config.CACHE_DIR}
+    if config.HF_TOKEN:
+        kwargs["token"] = config.HF_TOKEN
+    return kwargs
+
+
+def _from_hub(load, ref: str, **kwargs):
+    """
+    Call load(ref, **kwargs) with the Hub kwargs, from the local cache first so a cached
+    startup never touches the network. Only when the cache can't satisfy it (nothing cached
+    yet, or a snapshot left partial by an interrupted download) is the Hub contacted, which
+    also completes the snapshot.
+    """
+    if os.path.exists(ref):
+        return load(ref, **kwargs)
+
+    try:
+        return load(ref, local_files_only=True, **_hub_kwargs(ref), **kwargs)
+    except OSError as e:
+        # Includes huggingface_hub's LocalEntryNotFoundError
+        print(f"{ref} not fully cached, fetching from the Hub: {e}")
+        return load(ref, local_files_only=False, **_hub_kwargs(ref), **kwargs)
+
+
+def _model_revision(ref: str) -> str:
+    """
+    Identifies the weights behind a model reference: the commit of the Hub snapshot in use,
+    or for a local directory a hash of its file names, sizes and mtimes.
+    """
+    if os.path.isdir(ref):
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(ref)):
+            stat = os.stat(os.path.join(ref, name))
+            digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()[:12]
+    return _from_hub(AutoConfig.from_pretrained, ref)._commit_hash or "unknown"
+
+
+def _onnx_model_dir() -> str:
+    # Keyed by revision so a new Hub snapshot (or edited local model) gets a fresh export
+    quantized = config.DEVICE == "cpu" and config.QUANTIZE_CPU
+    name = "-".join([
+        config.MODEL_REF.strip("/").replace("/", "--"),
+        _model_revision(config.MODEL_REF),
+        *(["int8"] if quantized else []),
+    ])
+    return os.path.join(config.ONNX_DIR, name)
+
+
+def export_onnx_model() -> str:
+    """
+    Export the correction model to ONNX under config.ONNX_DIR, INT8-quantizing it on CPU like
+    the PyTorch path, unless that export already exists. Returns the export directory.
+    """
+    onnx_dir = _onnx_model_dir()
+    if os.path.isfile(os.path.join(onnx_dir, "config.json")):
+        return onnx_dir
+
+    tmp_dir = f"{onnx_dir}.tmp-{os.getpid()}"
+    model = _from_hub(ORTModelForSeq2SeqLM.from_pretrained, config.MODEL_REF, export=True)
+    model.save_pretrained(tmp_dir)
+
+    if onnx_dir.endswith("-int8"):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        for name in os.listdir(tmp_dir):
+            if name.endswith(".onnx"):
+                path = os.path.join(tmp_dir, name)
+                quantize_dynamic(path, f"{path}.int8", weight_type=QuantType.QInt8)
+                os.replace(f"{path}.int8", path)
+
+    # Publish atomically; if another worker got there first, keep its copy
+    try:
+        os.replace(tmp_dir, onnx_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return onnx_dir
+
+
+def download_models():
+    """
+    Populate the Hub cache with every Hub artifact the server loads at startup. Always checks
+    the Hub, so it completes partial snapshots and picks up new revisions.
+    """
+    if not os.path.exists(config.MODEL_REF):
+        snapshot_download(repo_id=config.MODEL_REF, local_files_only=False, **_hub_kwargs(config.MODEL_REF))
+    if config.DRAFT_MODEL_REF and not os.path.exists(config.DRAFT_MODEL_REF):
+        snapshot_download(
+            repo_id=config.DRAFT_MODEL_REF, local_files_only=False, **_hub_kwargs(config.DRAFT_MODEL_REF)
+        )
+    snapshot_download(
+        repo_id=config.ERROR_TAGGER_REPO,
+        repo_type=config.ERROR_TAGGER_REPO_TYPE,
+        local_files_only=False,
+        **_hub_kwargs(config.ERROR_TAGGER_REPO)
+    )
+    if config.USE_ONNXRUNTIME and ORTModelForSeq2SeqLM is not None:
+        export_onnx_model()
+
+
+def _download_error_classifier(repo_id: str, **hub_kwargs) -> str:
+    repo_dir = snapshot_download(repo_id=repo_id, repo_type=config.ERROR_TAGGER_REPO_TYPE, **hub_kwargs)
+    clf_path = os.path.join(repo_dir, config.ERROR_TAGGER_FILE)
+    if not os.path.exists(clf_path):
+        # FileNotFoundError is an OSError, so a partial cached snapshot is retried from the Hub
+        raise FileNotFoundError(
+            f"'{config.ERROR_TAGGER_FILE}' not found in HF repo snapshot: {repo_dir}. "
+            f"Make sure you uploaded it to {config.ERROR_TAGGER_REPO}."
+        )
+    return clf_path
+
+
+class StopAfterNewTokens(StoppingCriteria):
+    """
+    Stop once `max_new_tokens` tokens have been generated, independently of the max_new_tokens
+    passed to generate() (which, for a compiled model, sizes the static KV cache).
+    """
+
+    def __init__(self, max_new_tokens: int):
+        # Decoder ids start with the decoder_start_token
+        self.max_length = max_new_tokens + 1
+
+    def __call__(self, input_ids, scores, **kwargs):
+        is_done = input_ids.shape[-1] >= self.max_length
+        return torch.full((input_ids.shape[0],), is_done, device=input_ids.device, dtype=torch.bool)
+
+
 class ModelManager:
     def __init__(self):
         self.model = None
         self.tokenizer = None
+        self.prefix_ids = None
         self.device = config.DEVICE
         self.loaded = False
         self.model_ref = config.MODEL_REF
+        self.backend = None
+        self.draft_model = None
+        self.generation_config = None
+        self.compiled = False
 
         self.error_clf = None
         self.error_clf_loaded = False
         self.error_clf_effective_path = None
         self.error_clf_repo_dir = None
+        self.error_clf_features = None
+        self.error_clf_linear = None
 
     def load_model(self):
         """
@@ -124,63 +335,228 @@ class ModelManager:
 
     def _load_correction_model(self):
         model_ref = self.model_ref
-        is_local = os.path.exists(model_ref)
 
-        load_kwargs = {}
-        if (not is_local) and config.HF_TOKEN:
-            load_kwargs["token"] = config.HF_TOKEN
+        self.tokenizer = _from_hub(AutoTokenizer.from_pretrained, model_ref)
+        self.tokenizer.model_max_length = config.MAX_ENCODER_LEN
+        self.prefix_ids = self.tokenizer(config.INSTRUCTION_PREFIX, add_special_tokens=False).input_ids
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_ref, **load_kwargs)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_ref, **load_kwargs)
+        self.model = None
+        if config.USE_ONNXRUNTIME and ORTModelForSeq2SeqLM is not None:
+            try:
+                self.model = self._load_ort_model()
+                self.backend = "onnxruntime"
+            except Exception as e:
+                print(f"ONNX Runtime load failed, falling back to PyTorch: {e}")
+
+        if self.model is None:
+            self.model = self._load_torch_model(model_ref)
+            self.backend = "torch"
+
+        self.generation_config = self._build_generation_config()
+        if self.compiled:
+            try:
+                self._warmup()
+            except Exception as e:
+                # A failed compile must not take the server down; serve the eager model instead
+                print(f"Compiled warmup failed, falling back to eager PyTorch: {e}")
+                self._disable_compile()
+
+        self.draft_model = None
+        if config.DRAFT_MODEL_REF and self.backend == "torch":
+            try:
+                self.draft_model = self._load_draft_model(config.DRAFT_MODEL_REF)
+            except Exception as e:
+                print(f"Draft model failed to load, assisted decoding disabled: {e}")
 
-        self.model.to(self.device)
-        self.model.eval()
         self.loaded = True
 
+    def _load_ort_model(self):
+        on_cuda = self.device == "cuda"
+        return ORTModelForSeq2SeqLM.from_pretrained(
+            export_onnx_model(),
+            provider="CUDAExecutionProvider" if on_cuda else "CPUExecutionProvider",
+            use_io_binding=on_cuda,
+        )
+
+    def _load_torch_model(self, model_ref):
+        model_kwargs = {}
+        if self.device == "cuda":
+            # BF16 on Ampere+ (compute capability >= 8), FP16 on older GPUs; CPU loads in FP32
+            bf16_ok = torch.cuda.get_device_capability(0)[0] >= 8
+            model_kwargs["torch_dtype"] = torch.bfloat16 if bf16_ok else torch.float16
+            model_kwargs["device_map"] = {"": self.device}
+            # Any FP32 matmuls left (e.g. upcast layers) can use TF32 tensor cores on Ampere+
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        else:
+            # Split the cores between worker processes instead of oversubscribing them
+            torch.set_num_threads(max(1, os.cpu_count() // config.WORKERS))
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Can only be set once per process, before any inter-op work has started
+                pass
+
+        model = None
+        if self._supports_flash_attention(model_ref):
+            try:
+                model = _from_hub(
+                    AutoModelForSeq2SeqLM.from_pretrained, model_ref,
+                    attn_implementation="flash_attention_2", **model_kwargs
+                )
+            except (ValueError, ImportError) as e:
+                print(f"attn_implementation=flash_attention_2 unavailable: {e}")
+
+        if model is None:
+            # transformers already selects SDPA by default for architectures that support it
+            model = _from_hub(AutoModelForSeq2SeqLM.from_pretrained, model_ref, **model_kwargs)
+        model.eval()
+        model.requires_grad_(False)
+
+        if self.device == "cpu" and config.QUANTIZE_CPU:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        self.compiled = False
+        if self.device == "cuda" and config.TORCH_COMPILE and torch.__version__ >= "2.2":
+            # generate() calls the module itself, so compile forward rather than wrapping the module
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+            self.compiled = True
+
+        return model
+
+    def _supports_flash_attention(self, model_ref):
+        # Only request FlashAttention-2 when both the install and the model class support it;
+        # an unsupported request is only rejected after the weights have been read
+        if self.device != "cuda" or importlib.util.find_spec("flash_attn") is None:
+            return False
+        model_config = _from_hub(AutoConfig.from_pretrained, model_ref)
+        model_class = MODEL_FOR_SEQ_TO_SEQ_CAUSAL_LM_MAPPING.get(type(model_config), None)
+        return bool(getattr(model_class, "_supports_flash_attn_2", False))
+
+    def _build_generation_config(self):
+        gen_config = copy.deepcopy(self.model.generation_config)
+        gen_config.update(
+            num_beams=config.BEAM_WIDTH,
+            do_sample=False,
+            no_repeat_ngram_size=3,
+            repetition_penalty=1.1,
+            early_stopping=True,
+            use_cache=True,
+        )
+
+        # Fixed-shape KV cache, only for a compiled decoder step; eager decoding would just
+        # pre-allocate max-length KV buffers for nothing
+        if self.compiled and getattr(self.model, "_supports_static_cache", False):
+            gen_config.cache_implementation = "static"
+
+        return gen_config
+
+    def _disable_compile(self):
+        # Drop the compiled forward set on the instance so generate() uses the class's eager one
+        self.model.__dict__.pop("forward", None)
+        self.compiled = False
+        self.generation_config = self._build_generation_config()
+
+    def _warmup(self):
+        # Pay the compilation cost at startup rather than on the first real request, once per
+        # batch size and encoder length the compiled path pads to. max_new_tokens stays at the
+        # default bucket so the static cache has the serving shape, but a couple of decoder
+        # steps are enough to compile and capture them.
+        max_new_tokens = _round_up(config.DEFAULT_MAX_NEW_TOKENS, config.MAX_NEW_TOKENS_BUCKETS)
+        stopping_criteria = StoppingCriteriaList([StopAfterNewTokens(2)])
+        lengths = (*config.LENGTH_BUCKET_EDGES, config.MAX_ENCODER_LEN)
+        for batch_size, length in itertools.product(config.BATCH_SIZE_BUCKETS, lengths):
+            input_ids = torch.full(
+                (batch_size, length),
+                self.tokenizer.unk_token_id,
+                dtype=torch.long,
+                device=self.device,
+            )
+            with torch.inference_mode():
+                self.model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    generation_config=self.generation_config,
+                    max_new_tokens=max_new_tokens,
+                    stopping_criteria=stopping_criteria,
+                )
+
+    def _load_draft_model(self, draft_ref):
+        draft = _from_hub(AutoModelForSeq2SeqLM.from_pretrained, draft_ref, torch_dtype=self.model.dtype)
+        draft.to(self.device)
+        draft.eval()
+        draft.requires_grad_(False)
+        return draft
+
     def _load_error_classifier_from_hf(self):
         self.error_clf = None
         self.error_clf_loaded = False
         self.error_clf_effective_path = None
         self.error_clf_repo_dir = None
+        self.error_clf_features = None
+        self.error_clf_linear = None
 
-        snap_kwargs = {"repo_type": config.ERROR_TAGGER_REPO_TYPE}
-        if config.HF_TOKEN:
-            snap_kwargs["token"] = config.HF_TOKEN
-
-        repo_dir = snapshot_download(
-            repo_id=config.ERROR_TAGGER_REPO,
-            **snap_kwargs
-        )
+        clf_path = _from_hub(_download_error_classifier, config.ERROR_TAGGER_REPO)
+        repo_dir = os.path.dirname(clf_path)
         self.error_clf_repo_dir = repo_dir
 
-        clf_path = os.path.join(repo_dir, config.ERROR_TAGGER_FILE)
-        if not os.path.exists(clf_path):
-            raise FileNotFoundError(
-                f"'{config.ERROR_TAGGER_FILE}' not found in HF repo snapshot: {repo_dir}. "
-                f"Make sure you uploaded it to {config.ERROR_TAGGER_REPO}."
-            )
-
         self.error_clf = joblib.load(clf_path)
+        self.error_clf_features, self.error_clf_linear = self._split_linear_pipeline(self.error_clf)
         self.error_clf_loaded = True
         self.error_clf_effective_path = clf_path
         print(f"✓ Loaded error classifier (HF): {clf_path}")
 
+    @staticmethod
+    def _split_linear_pipeline(clf):
+        """
+        For a sklearn Pipeline ending in a linear classifier (e.g. TF-IDF + LogisticRegression),
+        return (feature steps, classifier) so predictions can skip Pipeline.predict's dispatch
+        and validation. Anything else returns (None, None) and goes through clf.predict.
+        """
+        steps = getattr(clf, "steps", None)
+        if not steps or len(steps) < 2:
+            return None, None
+
+        head = steps[-1][1]
+        if not all(hasattr(head, attr) for attr in ("coef_", "intercept_", "classes_")):
+            return None, None
+
+        return clf[:-1], head
+
 
 model_manager = ModelManager()
 
 @app.on_event("startup")
 async def startup_event():
+    global _batch_queue, _batch_worker_task, _infer_executor
+
     try:
         model_manager.load_model()
     except Exception as e:
         print(f"Model failed to load: {e}")
 
+    _infer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+    _batch_queue = asyncio.Queue()
+    _batch_worker_task = asyncio.create_task(_batch_worker())
+
 # =========================
 # Helper Functions
 # =========================
 
 def _wp_tokenize(text: str):
-    return re.findall(r"[A-Za-z]+(?:'[A-Za-z]+)?|\d+|[^\w\s]", text)
+    return _WP_RE.findall(text)
+
+
+def _join_tokens(tokens) -> str:
+    out = []
+    for tok in tokens:
+        if out and tok and tok[0] in _PUNCT:
+            out[-1] += tok
+        else:
+            out.append(tok)
+    return " ".join(out)
 
 
 def _micro_feedback_for(error_type: str) -> str:
@@ -215,30 +591,49 @@ def _predict_error_type_heuristic(change: dict) -> str:
     return "other"
 
 
-def _predict_error_type(change: dict) -> str:
-    if model_manager.error_clf_loaded and model_manager.error_clf is not None:
+def _predict_linear(texts: list) -> list:
+    head = model_manager.error_clf_linear
+    X = model_manager.error_clf_features.transform(texts)
+    scores = np.asarray(X @ head.coef_.T) + head.intercept_
+
+    if scores.shape[1] == 1:
+        # Binary linear models expose a single decision column
+        indices = (scores[:, 0] > 0).astype(int)
+    else:
+        indices = scores.argmax(axis=1)
+
+    return list(head.classes_[indices])
+
+
+def _predict_error_types(changes: list) -> list:
+    if changes and model_manager.error_clf_loaded and model_manager.error_clf is not None:
         try:
-            x = _normalize_pair_for_clf(change.get("from"), change.get("to"))
-            return model_manager.error_clf.predict([x])[0]
+            texts = [_normalize_pair_for_clf(c.get("from"), c.get("to")) for c in changes]
+            if model_manager.error_clf_linear is not None:
+                return _predict_linear(texts)
+            return list(model_manager.error_clf.predict(texts))
         except Exception:
             pass
 
-    return _predict_error_type_heuristic(change)
+    return [_predict_error_type_heuristic(c) for c in changes]
 
 
 def identify_changes(original: str, corrected: str):
     o_tokens = _wp_tokenize(original)
     c_tokens = _wp_tokenize(corrected)
 
-    sm = difflib.SequenceMatcher(None, o_tokens, c_tokens)
     changes = []
 
+    # difflib's matching blocks decide how edits are grouped into changes (and so num_errors,
+    # score and error types); a minimal edit script splits e.g. "goes" -> "am going" in two.
+    # autojunk off so long essays don't have frequent tokens like "the" discarded as junk.
+    sm = difflib.SequenceMatcher(None, o_tokens, c_tokens, autojunk=False)
     for tag, i1, i2, j1, j2 in sm.get_opcodes():
         if tag == "equal":
             continue
 
-        original_segment = " ".join(o_tokens[i1:i2]).replace(" ,", ",").replace(" .", ".")
-        corrected_segment = " ".join(c_tokens[j1:j2]).replace(" ,", ",").replace(" .", ".")
+        original_segment = _join_tokens(o_tokens[i1:i2])
+        corrected_segment = _join_tokens(c_tokens[j1:j2])
 
         if tag == "replace":
             change = {"type": "replaced", "from": original_segment, "to": corrected_segment}
@@ -249,44 +644,102 @@ def identify_changes(original: str, corrected: str):
         else:
             continue
 
-        error_type = _predict_error_type(change)
-        change["error_type"] = error_type
-        change["micro_feedback"] = _micro_feedback_for(error_type)
-
         changes.append(change)
         if len(changes) >= 50:
             break
 
+    # One classifier call for all changes instead of one per change
+    for change, error_type in zip(changes, _predict_error_types(changes)):
+        change["error_type"] = error_type
+        change["micro_feedback"] = _micro_feedback_for(error_type)
+
     return changes
 
 
-def correct_text(student_input: str, prompt: str = "", max_length: int = config.DEFAULT_MAX_NEW_TOKENS):
+def _round_up(n: int, sizes) -> int:
+    for size in sizes:
+        if n <= size:
+            return size
+    return n
+
+
+def _generation_max_new_tokens(max_new_tokens: int) -> int:
+    if model_manager.compiled:
+        return _round_up(max_new_tokens, config.MAX_NEW_TOKENS_BUCKETS)
+    return max_new_tokens
+
+
+def _encode_inputs(inputs: list[str]) -> list[list[int]]:
     if not model_manager.loaded:
         raise RuntimeError("Model not loaded")
 
-    input_text = f"{config.INSTRUCTION_PREFIX} {student_input}"
+    # Equivalent to tokenizing f"{INSTRUCTION_PREFIX} {text}" with truncation, without
+    # re-tokenizing the constant prefix: prefix + student tokens (cut to fit) + </s>
+    prefix_ids = model_manager.prefix_ids
+    eos_id = model_manager.tokenizer.eos_token_id
+    budget = config.MAX_ENCODER_LEN - len(prefix_ids) - 1
 
-    batch = model_manager.tokenizer(
-        input_text,
-        return_tensors="pt",
-        max_length=config.MAX_ENCODER_LEN,
-        truncation=True
-    )
-    batch = {k: v.to(model_manager.device) for k, v in batch.items()}
+    user_ids = model_manager.tokenizer(inputs, add_special_tokens=False)["input_ids"]
+    return [prefix_ids + ids[:budget] + [eos_id] for ids in user_ids]
+
+
+def _generate_batch(input_ids: list[list[int]], max_new_tokens: list[int]) -> list[str]:
+    if not model_manager.loaded:
+        raise RuntimeError("Model not loaded")
 
-    with torch.no_grad():
+    num_inputs = len(input_ids)
+    pad_kwargs = {}
+    if model_manager.compiled:
+        # Pad the batch up to a bucket size with copies of its last row, and each row to the
+        # length-bucket edge rather than the batch max, so the compiled graphs only ever see
+        # the shapes warmed at startup
+        batch_size = _round_up(num_inputs, config.BATCH_SIZE_BUCKETS)
+        input_ids = input_ids + [input_ids[-1]] * (batch_size - num_inputs)
+        longest = max(len(ids) for ids in input_ids)
+        pad_kwargs["padding"] = "max_length"
+        pad_kwargs["max_length"] = _round_up(
+            longest, (*config.LENGTH_BUCKET_EDGES, config.MAX_ENCODER_LEN)
+        )
+
+    batch = model_manager.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt", **pad_kwargs)
+    # BatchEncoding.to() takes no non_blocking argument on the pinned transformers 4.46
+    batch = {k: v.to(model_manager.device, non_blocking=True) for k, v in batch.items()}
+
+    # A compiled model generates with a bucketed max_new_tokens (the static cache shape), so
+    # stop at the largest caller limit in the batch and cut each output to its own limit
+    longest_limit = max(max_new_tokens)
+    generate_kwargs = {}
+    if model_manager.compiled:
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([StopAfterNewTokens(longest_limit)])
+    if model_manager.draft_model is not None and config.BEAM_WIDTH == 1 and num_inputs == 1:
+        # Assisted generation only supports greedy search on a single sequence
+        generate_kwargs["assistant_model"] = model_manager.draft_model
+
+    with torch.inference_mode():
         outputs = model_manager.model.generate(
             **batch,
-            max_new_tokens=max_length,
-            num_beams=6,
-            no_repeat_ngram_size=3,
-            repetition_penalty=1.1,
-            early_stopping=True,
+            generation_config=model_manager.generation_config,
+            max_new_tokens=_generation_max_new_tokens(longest_limit),
+            **generate_kwargs,
         )
 
-    corrected = model_manager.tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
+    # +1 for the decoder start token; zip drops the batch padding rows
+    outputs = [sequence[:limit + 1] for sequence, limit in zip(outputs, max_new_tokens)]
+    decoded = model_manager.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+    return [text.strip() for text in decoded]
+
+
+@functools.lru_cache(maxsize=config.CACHE_SIZE)
+def _identify_changes_cached(original: str, corrected: str):
+    return tuple(identify_changes(original, corrected))
+
 
-    changes = identify_changes(student_input, corrected)
+def _build_result(student_input: str, corrected: str, prompt: str = ""):
+    if corrected.strip() == student_input.strip():
+        # Already-correct text: nothing to diff or classify
+        changes = []
+    else:
+        changes = list(_identify_changes_cached(student_input, corrected))
     num_errors = len(changes)
     score = max(0, 10 - num_errors)
 
@@ -300,6 +753,139 @@ def correct_text(student_input: str, prompt: str = "", max_length: int = config.
         "has_errors": num_errors > 0,
     }
 
+
+def correct_text(student_input: str, prompt: str = "", max_length: int = config.DEFAULT_MAX_NEW_TOKENS):
+    key = _cache_key(student_input, max_length)
+    corrected = _correction_cache.get(key)
+    if corrected is None:
+        corrected = _generate_batch(_encode_inputs([student_input]), [max_length])[0]
+        _correction_cache.put(key, corrected)
+
+    return _build_result(student_input, corrected, prompt)
+
+# =========================
+# Correction Cache
+# =========================
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+_correction_cache = LRUCache(config.CACHE_SIZE)
+
+
+def _cache_key(student_input: str, max_new_tokens: int):
+    return " ".join(student_input.split()), max_new_tokens
+
+# =========================
+# Request Batching
+# =========================
+
+# Each queued item is (student_input, max_new_tokens, future).
+_batch_queue = None
+_batch_worker_task = None
+
+# Tokenization and generate() run here, off the event loop.
+# A single thread: inference is serialized on the model anyway.
+_infer_executor = None
+
+
+async def _collect_batch():
+    loop = asyncio.get_running_loop()
+    items = [await _batch_queue.get()]
+    deadline = loop.time() + config.BATCH_TIMEOUT_MS / 1000
+
+    while len(items) < config.MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+    # Take any backlog too, so it can be bucketed alongside this window
+    while not _batch_queue.empty():
+        items.append(_batch_queue.get_nowait())
+
+    return items
+
+
+def _length_bucket(num_tokens: int) -> int:
+    return bisect.bisect_right(config.LENGTH_BUCKET_EDGES, num_tokens)
+
+
+def _fail_futures(futures, exc: Exception):
+    for future in futures:
+        if not future.done():
+            future.set_exception(exc)
+
+
+async def _run_batch(group):
+    loop = asyncio.get_running_loop()
+    try:
+        corrected = await loop.run_in_executor(
+            _infer_executor,
+            _generate_batch,
+            [input_ids for input_ids, _, _ in group],
+            [max_new_tokens for _, max_new_tokens, _ in group],
+        )
+    except Exception as e:
+        _fail_futures([future for _, _, future in group], e)
+        return
+
+    for (_, _, future), text in zip(group, corrected):
+        if not future.done():
+            future.set_result(text)
+
+
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = await _collect_batch()
+
+        try:
+            encoded = await loop.run_in_executor(
+                _infer_executor, _encode_inputs, [text for text, _, _ in items]
+            )
+        except Exception as e:
+            _fail_futures([future for _, _, future in items], e)
+            continue
+
+        # Only batch inputs of similar token length (padding cost grows with the longest one),
+        # and that agree on max_new_tokens since generate() takes a single value.
+        buckets = {}
+        for (_, max_new_tokens, future), input_ids in zip(items, encoded):
+            key = (_length_bucket(len(input_ids)), _generation_max_new_tokens(max_new_tokens))
+            buckets.setdefault(key, []).append((input_ids, max_new_tokens, future))
+
+        # Drain the longest bucket first
+        for key in sorted(buckets, reverse=True):
+            group = buckets[key]
+            for start in range(0, len(group), config.MAX_BATCH):
+                await _run_batch(group[start:start + config.MAX_BATCH])
+
+
+async def _generate_queued(student_input: str, max_new_tokens: int) -> str:
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((student_input, max_new_tokens, future))
+    return await future
+
+
 # =========================
 # API Routes
 # =========================
@@ -310,6 +896,7 @@ async def root():
         "message": "FCE Error Correction API",
         "model_loaded": model_manager.loaded,
         "device": model_manager.device,
+        "backend": model_manager.backend,
         "model_ref": model_manager.model_ref,
         "error_classifier_loaded": model_manager.error_clf_loaded,
         "error_classifier_repo": config.ERROR_TAGGER_REPO,
@@ -332,11 +919,25 @@ async def correct(request: CorrectionRequest):
         raise HTTPException(status_code=400, detail="student_input cannot be empty")
 
     try:
-        return CorrectionResponse(**correct_text(
-            student_input=request.student_input,
-            prompt=request.prompt,
-            max_length=request.max_length
-        ))
+        if _batch_queue is None:
+            result = correct_text(
+                student_input=request.student_input,
+                prompt=request.prompt,
+                max_length=request.max_length
+            )
+        else:
+            key = _cache_key(request.student_input, request.max_length)
+            corrected = _correction_cache.get(key)
+            if corrected is None:
+                corrected = await _generate_queued(request.student_input, request.max_length)
+                _correction_cache.put(key, corrected)
+            # Diffing/tagging is CPU-light: keep it off the inference thread so it never
+            # queues behind in-flight generate batches
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, _build_result, request.student_input, corrected, request.prompt
+            )
+
+        return CorrectionResponse(**result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -345,5 +946,21 @@ async def correct(request: CorrectionRequest):
 # =========================
 
 if __name__ == "__main__":
+    import sys
+
+    if "--download-only" in sys.argv:
+        download_models()
+        sys.exit(0)
+
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    uvicorn.run(
+        "fastapi_server:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=8000,
+        workers=config.WORKERS,
+        # uvloop/httptools when installed (uvicorn[standard]), asyncio/h11 elsewhere, e.g. Windows
+        loop="auto",
+        http="auto",
+        log_level="info"
+    )
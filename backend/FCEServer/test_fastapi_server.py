@@ -0,0 +1,97 @@
+import pytest
+
+import fastapi_server
+from fastapi_server import identify_changes
+
+
+# (original, corrected, expected changes as (type, from, to, error_type)), as returned by the
+# original difflib-based identify_changes with the heuristic tagger (no classifier loaded)
+BASELINE_CASES = [
+    (
+        "I goes to school.",
+        "I am going to school.",
+        [("replaced", "goes", "am going", "other")],
+    ),
+    (
+        "Dear Sir, Thanks for you letter. I am very exciting to hear I win the prize.",
+        "Dear Sir, Thanks for your letter. I am very excited to hear that I won the prize.",
+        [
+            ("replaced", "you", "your", "other"),
+            ("replaced", "exciting", "excited", "other"),
+            ("added", None, "that", "missing word"),
+            ("replaced", "win", "won", "other"),
+        ],
+    ),
+    (
+        "In my school, student learn many subject. They enjoy study in library.",
+        "In my school, students learn many subjects. They enjoy studying in the library.",
+        [
+            ("replaced", "student", "students", "agreement/plural"),
+            ("replaced", "subject", "subjects", "agreement/plural"),
+            ("replaced", "study", "studying", "other"),
+            ("added", None, "the", "articles/determiners"),
+        ],
+    ),
+    (
+        "She don't like coffee. He have three brother.",
+        "She doesn't like coffee. He has three brothers.",
+        [
+            ("replaced", "don't", "doesn't", "other"),
+            ("replaced", "have", "has", "other"),
+            ("replaced", "brother", "brothers", "agreement/plural"),
+        ],
+    ),
+    (
+        "Last summer I go to Spain with my family. We stay at hotel near the beach.",
+        "Last summer I went to Spain with my family. We stayed at a hotel near the beach.",
+        [
+            ("replaced", "go", "went", "other"),
+            ("replaced", "stay", "stayed", "other"),
+            ("added", None, "a", "articles/determiners"),
+        ],
+    ),
+    (
+        "I goes there!",
+        "I went.",
+        [("replaced", "goes there !", "went.", "other")],
+    ),
+]
+
+
+@pytest.fixture(autouse=True)
+def heuristic_tagger(monkeypatch):
+    monkeypatch.setattr(fastapi_server.model_manager, "error_clf_loaded", False)
+
+
+@pytest.mark.parametrize("original, corrected, expected", BASELINE_CASES)
+def test_identify_changes_matches_baseline(original, corrected, expected):
+    changes = identify_changes(original, corrected)
+    assert [(c["type"], c["from"], c["to"], c["error_type"]) for c in changes] == expected
+
+
+def test_identify_changes_no_edits():
+    assert identify_changes("I go to school.", "I go to school.") == []
+
+
+def test_from_hub_falls_back_to_network_when_cache_is_incomplete():
+    calls = []
+
+    def load(ref, local_files_only, **kwargs):
+        calls.append(local_files_only)
+        if local_files_only:
+            raise OSError("partial snapshot")
+        return ref
+
+    assert fastapi_server._from_hub(load, "org/model") == "org/model"
+    assert calls == [True, False]
+
+
+def test_from_hub_skips_network_when_cached():
+    calls = []
+
+    def load(ref, local_files_only, **kwargs):
+        calls.append(local_files_only)
+        return ref
+
+    fastapi_server._from_hub(load, "org/model")
+    assert calls == [True]
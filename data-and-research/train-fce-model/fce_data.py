@@ -0,0 +1,354 @@
+"""
+FCE dataset parsing shared by the training scripts.
+Parses the prompt and learner XML files and caches the results next to the data.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree as ET
+from tqdm import tqdm
+
+# =========================
+# Error type mapping
+# =========================
+ERROR_TYPES = {
+    'RP': 'Punctuation',
+    'DD': 'Determiner/Possessive',
+    'RJ': 'Adjective form',
+    'MD': 'Missing Determiner',
+    'TV': 'Verb tense',
+    'RT': 'Wrong preposition',
+    'S': 'Spelling',
+    'MT': 'Missing word',
+    'RV': 'Wrong verb',
+    'MP': 'Missing punctuation',
+    'AGN': 'Agreement (noun)',
+    'RN': 'Wrong noun',
+    'FN': 'Noun form',
+    'FV': 'Verb form',
+    'UQ': 'Unnecessary quantifier',
+    'UA': 'Unnecessary article',
+    'UT': 'Unnecessary word',
+    'MC': 'Missing conjunction',
+    'MA': 'Missing article',
+    'DN': 'Derivation (noun)',
+    'UV': 'Unnecessary verb',
+    'AGA': 'Agreement (article)',
+    'AGV': 'Agreement (verb)',
+
+    # Common extra codes in your sample files (optional, for nicer logs)
+    'UP': 'Unnecessary punctuation',
+    'R':  'Replacement/word choice',
+    'RD': 'Reference/Determiner',
+    'W':  'Word order',
+    'ID': 'Idiomatic usage',
+    'UY': 'Unclear/Style',
+    'RA': 'Reference/Pronoun'
+}
+
+# Bound once; looked up for every <NS> correction while parsing
+_ERROR_TYPES_GET = ERROR_TYPES.get
+
+# =========================
+# Parse cache
+# =========================
+# Streamed with iterparse; recover from the odd malformed file instead of dropping it
+# Comments and processing instructions are dropped so their text never reaches the samples
+XML_PARSE_OPTIONS = {"huge_tree": True, "recover": True, "remove_comments": True, "remove_pis": True}
+
+# Bump when the cache layout changes; edits to this module invalidate caches on their own
+CACHE_FORMAT_VERSION = 2
+
+def _source_signature():
+    """Hash of this module's source, so any change to the parsing code invalidates old caches."""
+    digest = hashlib.sha1(f"{CACHE_FORMAT_VERSION}\n".encode())
+    digest.update(Path(__file__).read_bytes())
+    return digest.hexdigest()
+
+PARSER_SIGNATURE = _source_signature()
+
+def release_element(elem):
+    """Free a processed subtree and the siblings handled before it."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+def files_signature(paths):
+    """Hash of file names, sizes and mtimes plus the parser source; changes when either does."""
+    digest = hashlib.sha1(PARSER_SIGNATURE.encode())
+    for path in paths:
+        stat = path.stat()
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def cache_path(directory, kind):
+    # Both scripts build the same samples, so one cache per data directory serves them both
+    return Path(directory) / f".fce_{kind}_cache.json"
+
+def load_cache(path, signature):
+    """Return the cached value when its signature matches, else None."""
+    # JSON rather than pickle: the cache sits in a shared data directory, and loading
+    # it must never run code from a file someone else could have written
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("signature") != signature:
+        return None
+    return cached.get("value")
+
+def save_cache(path, signature, value):
+    """Write the cache atomically so an interrupted run never leaves a truncated file behind."""
+    tmp_path = Path(f"{path}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"signature": signature, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        tmp_path.unlink(missing_ok=True)
+        print(f"Could not write cache {path}: {e}")
+
+# =========================
+# Prompt parser
+# =========================
+class PromptParser:
+    def __init__(self, prompts_path):
+        self.prompts_path = prompts_path
+        self.prompts = {}
+        self.load_prompts()
+
+    def load_prompts(self):
+        prompt_count = 0
+        failed_files = 0
+        xml_files = sorted(Path(self.prompts_path).glob("*.xml"))
+
+        # Reuse the parsed prompts until a prompt file changes
+        self.signature = files_signature(xml_files)
+        prompts_cache = cache_path(self.prompts_path, "prompts")
+        cached = load_cache(prompts_cache, self.signature)
+        if cached is not None:
+            self.prompts = cached
+            print(f"Loaded {len(self.prompts)} prompts from cache {prompts_cache}")
+            return
+
+        for xml_file in xml_files:
+            try:
+                for _, exam in ET.iterparse(str(xml_file), events=("end",), tag="exam", **XML_PARSE_OPTIONS):
+                    exam_id = f"{exam.get('x')}*{exam.get('y')}"
+                    for question in exam.iterfind('.//q'):
+                        q_num = question.get('n')
+                        prompt_text = ' '.join(''.join(question.itertext()).split())
+                        self.prompts[f"{exam_id}*{q_num}"] = prompt_text
+                        prompt_count += 1
+                    release_element(exam)
+            except Exception as e:
+                failed_files += 1
+                print(f"Error loading prompts from {xml_file}: {e}")
+
+        # A partial result must not be cached: the failed files would never be retried
+        if failed_files:
+            print(f"Not caching prompts: {failed_files} file(s) failed to parse")
+        else:
+            save_cache(prompts_cache, self.signature, self.prompts)
+        print(f"Loaded {prompt_count} prompts from {len(xml_files)} XML files")
+        if prompt_count > 0:
+            sample_keys = list(self.prompts.keys())[:3]
+            print(f"Sample prompt keys: {sample_keys}")
+
+    def get_prompt(self, exam_id, question_num):
+        key = f"{exam_id}*{question_num}"
+        return self.prompts.get(key, "")
+
+# =========================
+# FCE data parser
+# =========================
+class FCEDataParser:
+    def __init__(self, dataset_path, prompt_parser):
+        self.dataset_path = dataset_path
+        self.prompt_parser = prompt_parser
+        self.data = []
+
+    @staticmethod
+    def parse_coded_answer(coded_answer_elem):
+        original_parts, corrected_parts = [], []
+        corrections = []
+        # Pre-bound appends: the walker runs for every element of every answer
+        original_append = original_parts.append
+        corrected_append = corrected_parts.append
+        corrections_append = corrections.append
+
+        def process_element(elem):
+            if elem.text:
+                original_append(elem.text)
+                corrected_append(elem.text)
+
+            for child in elem:
+                if child.tag == 'NS':
+                    error_type = child.get('type', 'UNKNOWN')
+                    i_elem = child.find('i')
+                    c_elem = child.find('c')
+                    incorrect = ''.join(i_elem.itertext()) if i_elem is not None else ""
+                    correct = ''.join(c_elem.itertext()) if c_elem is not None else ""
+
+                    if incorrect or correct:
+                        corrections_append({
+                            'error_type': error_type,
+                            'incorrect': incorrect,
+                            'correct': correct,
+                            'error_name': _ERROR_TYPES_GET(error_type, 'Unknown')
+                        })
+
+                    # Original keeps the learner's <i> text; corrected prefers <c>
+                    original_append(incorrect)
+                    corrected_append(correct or incorrect)
+                elif isinstance(child.tag, str):
+                    # Comments/PIs (non-string tag) only contribute their tail
+                    process_element(child)
+
+                if child.tail:
+                    original_append(child.tail)
+                    corrected_append(child.tail)
+
+        process_element(coded_answer_elem)
+        return ''.join(original_parts), ''.join(corrected_parts), corrections
+
+    @staticmethod
+    def parse_file(xml_file, prompts):
+        """
+        Parse one FCE learner file.
+        Returns (samples, matched_keys, missing_keys) where the key lists record
+        the prompt lookup key of every answer, split by whether a prompt was found.
+        """
+        samples, matched_keys, missing_keys = [], [], []
+        for _, head in ET.iterparse(str(xml_file), events=("end",), tag="head", **XML_PARSE_OPTIONS):
+            sortkey = head.get('sortkey', '')
+            parts = sortkey.split('*')
+            if len(parts) < 3:
+                release_element(head)
+                continue
+            exam_id = f"{parts[1]}*{parts[2]}"
+
+            candidate = head.find('.//candidate')
+            language = ""
+            age = ""
+            if candidate is not None:
+                lang_elem = candidate.find('.//language')
+                age_elem = candidate.find('.//age')
+                if lang_elem is not None:
+                    language = lang_elem.text or ""
+                if age_elem is not None:
+                    age = age_elem.text or ""
+
+            for answer in head.iterfind('text/*'):
+                q_num_elem = answer.find('question_number')
+                if q_num_elem is None:
+                    continue
+                q_num = q_num_elem.text
+
+                lookup_key = f"{exam_id}*{q_num}"
+                prompt = prompts.get(lookup_key, "")
+                if prompt:
+                    matched_keys.append(lookup_key)
+                else:
+                    missing_keys.append(lookup_key)
+
+                coded_answer = answer.find('coded_answer')
+                if coded_answer is None:
+                    continue
+
+                original, corrected, corrections = FCEDataParser.parse_coded_answer(coded_answer)
+                if corrections:
+                    samples.append({
+                        'prompt': prompt,
+                        'original_text': original.strip(),
+                        'corrected_text': corrected.strip(),
+                        'corrections': corrections,
+                        'language': language,
+                        'age': age
+                    })
+
+            release_element(head)
+        return samples, matched_keys, missing_keys
+
+    def parse_dataset(self, show_mappings=False):
+        """Parse every learner file under the dataset folders; show_mappings also reports prompt lookups."""
+        print("Parsing FCE dataset...")
+        prompts_found = 0
+        prompts_missing = 0
+        failed_files = 0
+        sample_mappings = []
+        prompts = self.prompt_parser.prompts
+
+        # Listed once, in a stable order, so the tqdm total and sample order are reproducible
+        folders = [p for p in sorted(Path(self.dataset_path).iterdir()) if p.is_dir()]
+        xml_paths = [xml_file for folder in folders for xml_file in sorted(folder.glob("*.xml"))]
+
+        # Samples embed prompt text, so the cache is keyed on the prompts as well
+        signature = files_signature(xml_paths) + self.prompt_parser.signature
+        data_cache = cache_path(self.dataset_path, "dataset")
+        cached = load_cache(data_cache, signature)
+        if cached is not None:
+            self.data = cached
+            print(f"Loaded {len(self.data)} samples from cache {data_cache}")
+            return self.data
+
+        # Files are independent: parse them across processes, results come back in file order
+        with ProcessPoolExecutor(initializer=_init_parse_worker, initargs=(prompts,)) as ex:
+            results = ex.map(_parse_one_file, xml_paths, chunksize=8)
+            for xml_file, (samples, matched_keys, missing_keys, error) in tqdm(zip(xml_paths, results), total=len(xml_paths)):
+                if error:
+                    failed_files += 1
+                    print(f"Error parsing {xml_file}: {error}")
+                    continue
+                self.data.extend(samples)
+
+                if show_mappings:
+                    for lookup_key in matched_keys:
+                        if len(sample_mappings) >= 3:
+                            break
+                        prompt = prompts[lookup_key]
+                        sample_mappings.append({
+                            'key': lookup_key,
+                            'prompt_preview': prompt[:80] + '...' if len(prompt) > 80 else prompt
+                        })
+                    for lookup_key in missing_keys[:max(3 - prompts_missing, 0)]:
+                        print(f"⚠️  No prompt found for key: {lookup_key}")
+
+                prompts_found += len(matched_keys)
+                prompts_missing += len(missing_keys)
+
+        # A partial result must not be cached: the failed files would never be retried
+        if failed_files:
+            print(f"Not caching samples: {failed_files} file(s) failed to parse")
+        else:
+            save_cache(data_cache, signature, self.data)
+        print(f"\nParsed {len(self.data)} samples with corrections")
+        print(f"Prompt mapping: {prompts_found} matched, {prompts_missing} missing")
+
+        if sample_mappings:
+            print("\nSample mappings (first 3):")
+            for i, mapping in enumerate(sample_mappings, 1):
+                print(f"  {i}. Key: {mapping['key']}")
+                print(f"     Prompt: {mapping['prompt_preview']}")
+
+        if show_mappings and prompts_missing > 0:
+            print(f"\n⚠️  Warning: {prompts_missing} answers have no matching prompt")
+            print(f"   These will train without context (using fallback format)")
+
+        return self.data
+
+_worker_prompts = {}
+
+def _init_parse_worker(prompts):
+    global _worker_prompts
+    _worker_prompts = prompts
+
+def _parse_one_file(xml_file):
+    """Worker entry point; errors are returned so the parent reports them instead of the worker printing."""
+    try:
+        return (*FCEDataParser.parse_file(xml_file, _worker_prompts), None)
+    except Exception as e:
+        return [], [], [], str(e)
@@ -0,0 +1,290 @@
+"""
+Dataset, batching and test-time generation shared by the training scripts.
+Everything script-specific (paths, prefix, token budgets) comes from the caller's config.
+"""
+import functools
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from transformers import T5TokenizerFast, T5ForConditionalGeneration
+
+# =========================
+# Token helpers (priority to student text)
+# =========================
+def tokenize(text, tokenizer):
+    return tokenizer.encode(text, add_special_tokens=False)
+
+def decode_ids(ids, tokenizer):
+    return tokenizer.decode(ids, skip_special_tokens=True)
+
+@functools.lru_cache(maxsize=4096)
+def token_count(text, tokenizer):
+    return len(tokenize(text, tokenizer))
+
+@functools.lru_cache(maxsize=4096)
+def trim_to_tokens(text, tokenizer, max_tokens):
+    ids = tokenize(text, tokenizer)
+    if len(ids) <= max_tokens:
+        return text
+    # Keep the *last* tokens (more likely to include conclusions / endings)
+    trimmed = ids[-max_tokens:]
+    return decode_ids(trimmed, tokenizer)
+
+def build_input_text(prompt: str, student_text: str, config):
+    """
+    Stable instruction + optional prompt + student answer.
+    We will allocate token budget so the student_text is preserved first.
+    """
+    if prompt:
+        return (
+            f"{config.INSTRUCTION_PREFIX} "
+            f" Question: {prompt} "
+            f" Answer: {student_text}"
+        )
+    else:
+        return f"{config.INSTRUCTION_PREFIX} {student_text}"
+
+def compose_and_trim(prompt, student_text, tokenizer, prefix, prompt_max_tokens, max_encoder_len):
+    """
+    Ensure the student text gets priority. Shared by training and test so both see the same inputs.
+    1) Build instruction + (capped prompt) + answer.
+    2) If still > max_encoder_len, drop the prompt entirely.
+    3) If still > max, keep the last tokens of the *answer*.
+    """
+    if prompt:
+        # Cap the prompt first
+        prompt_capped = trim_to_tokens(prompt, tokenizer, prompt_max_tokens)
+        base = f"{prefix} Question: {prompt_capped} Answer: "
+    else:
+        base = f"{prefix} "
+
+    # Now compute budgets
+    base_len = token_count(base, tokenizer)
+    ans_ids = tokenize(student_text, tokenizer)
+
+    # If fits, great
+    if base_len + len(ans_ids) <= max_encoder_len:
+        return base + student_text
+
+    # Try dropping the prompt entirely
+    base_no_prompt = f"{prefix} "
+    prefix_len = token_count(base_no_prompt, tokenizer)
+    if prefix_len + len(ans_ids) <= max_encoder_len:
+        return base_no_prompt + student_text
+
+    # Still too long: keep the last tokens of the answer to fit budget
+    remaining = max(max_encoder_len - prefix_len, 0)
+    kept_ans = decode_ids(ans_ids[-remaining:], tokenizer)
+    return base_no_prompt + kept_ans
+
+# =========================
+# Dataset
+# =========================
+class FCEDataset(Dataset):
+    def __init__(self, data, tokenizer, config, precompute=True):
+        self.data = data
+        self.tokenizer = tokenizer
+        # Copied off the config so DataLoader workers only pickle plain values
+        self.instruction_prefix = config.INSTRUCTION_PREFIX
+        self.max_encoder_len = config.MAX_ENCODER_LEN
+        self.max_target_len = config.MAX_NEW_TOKENS
+        self.prompt_max_tokens = config.PROMPT_MAX_TOKENS
+        self._prefix_len = token_count(f"{self.instruction_prefix} ", tokenizer)
+        self.precompute = precompute
+        if precompute:
+            self._encode_all()
+            self.lengths = np.array([len(ids) for ids in self.input_ids])
+        else:
+            self.lengths = self._estimate_lengths()
+
+    def __len__(self):
+        return len(self.data)
+
+    def _encode(self, items):
+        """
+        Tokenize samples with one batched call per side. Token ids are kept unpadded
+        as int32 arrays; the attention mask is rebuilt from lengths at collate time.
+        """
+        input_texts = [self._compose_and_trim(item['prompt'], item['original_text']) for item in items]
+        target_texts = [item['corrected_text'] for item in items]
+
+        input_encoding = self.tokenizer(
+            input_texts,
+            max_length=self.max_encoder_len,
+            truncation=True,
+            return_attention_mask=False
+        )
+
+        # Target can also be long;  we cap it via max_length here for label tensor,
+        # while generation uses config.MAX_NEW_TOKENS later.
+        target_encoding = self.tokenizer(
+            target_texts,
+            max_length=self.max_target_len,
+            truncation=True,
+            return_attention_mask=False
+        )
+
+        input_ids = [np.asarray(ids, dtype=np.int32) for ids in input_encoding['input_ids']]
+        labels = [np.asarray(ids, dtype=np.int32) for ids in target_encoding['input_ids']]
+        return input_ids, labels
+
+    def _encode_all(self, chunk_size=1024):
+        """
+        Tokenize every sample once, in batched tokenizer calls, so __getitem__
+        only indexes precomputed token ids instead of re-tokenizing each epoch.
+        """
+        self.input_ids, self.labels = [], []
+        for start in range(0, len(self.data), chunk_size):
+            input_ids, labels = self._encode(self.data[start:start + chunk_size])
+            self.input_ids.extend(input_ids)
+            self.labels.extend(labels)
+
+    def _estimate_lengths(self, chars_per_token=4):
+        """
+        Approximate encoder lengths for length-bucketed batching when samples are encoded
+        lazily, from character counts, so nothing is tokenized up front. Buckets only need
+        samples ordered roughly by length.
+        """
+        lengths = []
+        for item in self.data:
+            prompt_len = min(len(item['prompt']) // chars_per_token, self.prompt_max_tokens)
+            answer_len = len(item['original_text']) // chars_per_token
+            lengths.append(min(self._prefix_len + prompt_len + answer_len, self.max_encoder_len))
+        return np.array(lengths)
+
+    def _compose_and_trim(self, prompt, original_text):
+        return compose_and_trim(
+            prompt, original_text, self.tokenizer,
+            self.instruction_prefix, self.prompt_max_tokens, self.max_encoder_len
+        )
+
+    def __getitem__(self, idx):
+        if self.precompute:
+            return {'input_ids': self.input_ids[idx], 'labels': self.labels[idx]}
+
+        input_ids, labels = self._encode([self.data[idx]])
+        return {'input_ids': input_ids[0], 'labels': labels[0]}
+
+
+def collate_batch(batch, pad_token_id, pad_to_multiple_of=8):
+    """
+    Pad a batch of int32 id arrays to its longest member (rounded up to a multiple
+    of pad_to_multiple_of), building the attention mask from the true lengths.
+    Module-level so DataLoader workers can pickle it.
+    """
+    def pad(seqs, fill):
+        longest = max(len(seq) for seq in seqs)
+        longest = -(-longest // pad_to_multiple_of) * pad_to_multiple_of
+        out = np.full((len(seqs), longest), fill, dtype=np.int64)
+        for row, seq in enumerate(seqs):
+            out[row, :len(seq)] = seq
+        return out
+
+    input_ids = [item['input_ids'] for item in batch]
+    labels = [item['labels'] for item in batch]
+
+    padded_inputs = pad(input_ids, pad_token_id)
+    lengths = np.array([len(seq) for seq in input_ids])
+    attention_mask = (np.arange(padded_inputs.shape[1]) < lengths[:, None]).astype(np.int64)
+
+    return {
+        'input_ids': torch.from_numpy(padded_inputs),
+        'attention_mask': torch.from_numpy(attention_mask),
+        'labels': torch.from_numpy(pad(labels, -100))
+    }
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length so dynamic padding wastes
+    few tokens. With shuffle, indices are permuted, split into pools of
+    pool_batches * batch_size, sorted by length inside each pool, cut into
+    batches, and the batch order is shuffled. Without shuffle, batches follow
+    global length order.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=100, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_batches * batch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return -(-len(self.lengths) // self.batch_size)
+
+    def __iter__(self):
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            for start in range(0, len(order), self.batch_size):
+                yield order[start:start + self.batch_size].tolist()
+            return
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        indices = rng.permutation(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start:start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+
+        for i in rng.permutation(len(batches)):
+            yield batches[i]
+
+# =========================
+# Testing
+# =========================
+@functools.lru_cache(maxsize=None)
+def load_test_artifacts(model_path, device):
+    """Load a trained tokenizer and model once per path and share them across test calls."""
+    tokenizer = T5TokenizerFast.from_pretrained(model_path)
+    model_kwargs = {}
+    if device == "cuda":
+        # Half precision for inference; bf16 where supported since T5 activations can overflow fp16.
+        # Set at load time so T5's _keep_in_fp32_modules (the FF output layers) stay in fp32
+        model_kwargs["torch_dtype"] = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    model = T5ForConditionalGeneration.from_pretrained(model_path, **model_kwargs)
+    model.to(device)
+    model.eval()
+    return tokenizer, model
+
+def compose_for_test(prompt, student_text, tokenizer, config):
+    """Compose a test input exactly as FCEDataset composes training inputs."""
+    return compose_and_trim(
+        prompt, student_text, tokenizer,
+        config.INSTRUCTION_PREFIX, config.PROMPT_MAX_TOKENS, config.MAX_ENCODER_LEN
+    )
+
+def generate_corrections(input_texts, tokenizer, model, config):
+    """Run one batched beam search over all inputs and decode the outputs together."""
+    encoding = tokenizer(
+        input_texts, padding='longest', return_tensors='pt',
+        max_length=config.MAX_ENCODER_LEN, truncation=True
+    ).to(config.DEVICE)
+
+    with torch.no_grad():
+        outputs = model.generate(
+            encoding['input_ids'],
+            attention_mask=encoding['attention_mask'],
+            max_new_tokens=config.MAX_NEW_TOKENS,
+            num_beams=config.NUM_BEAMS,
+            do_sample=False,
+            use_cache=True,
+            no_repeat_ngram_size=3,
+            repetition_penalty=1.1,
+            length_penalty=1.0,
+            early_stopping=True
+        )
+
+    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+def correct_pairs(pairs, config):
+    """
+    Correct a list of (prompt, student_input) pairs from config.MODEL_SAVE_PATH with
+    a single padded generate call. Returns the corrected texts in order.
+    """
+    tokenizer, model = load_test_artifacts(config.MODEL_SAVE_PATH, config.DEVICE)
+    input_texts = [compose_for_test(prompt, student_input, tokenizer, config) for prompt, student_input in pairs]
+    return generate_corrections(input_texts, tokenizer, model, config)
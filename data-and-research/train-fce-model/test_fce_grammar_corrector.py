@@ -1,9 +1,13 @@
 import torch
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+from transformers import T5TokenizerFast, T5ForConditionalGeneration
 import os
 import re
 import difflib
 
+_WP_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SPACE_BEFORE_PUNCT_RE = re.compile(r" ([,.])")
+
+
 class FCEErrorCorrector:
     """Test interface for the trained FCE error correction model"""
     
@@ -15,7 +19,7 @@ class FCEErrorCorrector:
         print(f"Using device: {self.device}")
         
         try:
-            self.tokenizer = T5Tokenizer.from_pretrained(model_path)
+            self.tokenizer = T5TokenizerFast.from_pretrained(model_path)
             self.model = T5ForConditionalGeneration.from_pretrained(model_path)
             self.model.to(self.device)
             self.model.eval()
@@ -87,7 +91,7 @@ class FCEErrorCorrector:
     @staticmethod
     def _wp_tokenize(s: str):
         """Tokenize text into words and punctuation."""
-        return re.findall(r"\w+|[^\w\s]", s, re.UNICODE)
+        return _WP_RE.findall(s)
     
     def _identify_changes(self, original, corrected):
         """
@@ -97,10 +101,10 @@ class FCEErrorCorrector:
         o_tokens = self._wp_tokenize(original)
         c_tokens = self._wp_tokenize(corrected)
         
-        sm = difflib.SequenceMatcher(None, o_tokens, c_tokens)
-        
         changes = []
         
+        # autojunk off: long essays must not have frequent tokens dropped as junk
+        sm = difflib.SequenceMatcher(None, o_tokens, c_tokens, autojunk=False)
         for tag, i1, i2, j1, j2 in sm.get_opcodes():
             if tag == "equal":
                 continue
@@ -109,8 +113,8 @@ class FCEErrorCorrector:
             corrected_segment = " ".join(c_tokens[j1:j2])
             
             # Clean up spacing around punctuation
-            original_segment = original_segment.replace(" ,", ",").replace(" .", ".")
-            corrected_segment = corrected_segment.replace(" ,", ",").replace(" .", ".")
+            original_segment = _SPACE_BEFORE_PUNCT_RE.sub(r"\1", original_segment)
+            corrected_segment = _SPACE_BEFORE_PUNCT_RE.sub(r"\1", corrected_segment)
             
             if tag == "replace":
                 changes.append({